@@ -23,8 +23,9 @@ avrChipDB = {
 }
 
 
+_sigIndex = {tuple(chip['signature']): chip for chip in avrChipDB.values()}
+assert len(_sigIndex) == len(avrChipDB), "Duplicate signature in avrChipDB"
+
+
 def getChipFromDB(sig):
-	for chip in avrChipDB.values():
-		if chip['signature'] == sig:
-			return chip
-	return False
+	return _sigIndex.get(tuple(sig), False)
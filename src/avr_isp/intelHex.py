@@ -3,7 +3,8 @@ Created on 2017年8月15日
 
 @author: CreatBot-SW
 '''
-import io
+import logging
+import string
 
 #===============================================================================
 # Module to read intel hex files into binary data blobs.
@@ -11,51 +12,83 @@ import io
 # See: http://en.wikipedia.org/wiki/Intel_HEX
 #===============================================================================
 
+log = logging.getLogger(__name__)
+
 
 def readHex(filename):
 	"""
-	Read an verify an intel hex file. Return the data as an list of bytes.
+	Read an verify an intel hex file. Return the data as a bytearray.
+	Gaps between records are filled with 0xFF, the value of erased flash.
 	"""
-	data = []
+	records = []
+	end = 0
 	extraAddr = 0
-	f = io.open(filename, "r")
-	for line in f:
+	with open(filename, "rb") as f:
+		lines = f.read().splitlines()
+	for line in lines:
 		line = line.strip()
-		if line[0] != ':':
-			raise formatError("Hex file must start with ':' @ " + line)
-		recLen = int(line[1:3], 16)
-		addr = int(line[3:7], 16) + extraAddr
-		recType = int(line[7:9], 16)
-		if len(line) != recLen * 2 + 11:
-			raise formatError("Length error in hex file @ " + line)
-		checkSum = 0
-		for i in range(0, recLen + 5):
-			checkSum += int(line[i * 2 + 1:i * 2 + 3], 16)
-		checkSum &= 0xFF
-		if checkSum != 0:
-			raise formatError("Checksum error in hex file @ " + line)
+		if not line:
+			continue
+		if line[0:1] != b':':
+			raise formatError("Hex file must start with ':' @ " + line.decode("ascii", "replace"))
+		if len(line) % 2 == 0:
+			raise formatError("Length error in hex file @ " + line.decode("ascii", "replace"))
+		try:
+			raw = bytes.fromhex(line[1:].decode("ascii"))
+		except ValueError:
+			raise formatError("Invalid hex digit in " + _badField(line) + " field @ " + line.decode("ascii", "replace"))
+		if len(raw) < 5 or len(raw) != raw[0] + 5:
+			raise formatError("Length error in hex file @ " + line.decode("ascii"))
+		if sum(raw) & 0xFF != 0:
+			raise formatError("Checksum error in hex file @ " + line.decode("ascii"))
+		recLen = raw[0]
+		addr = ((raw[1] << 8) | raw[2]) + extraAddr
+		recType = raw[3]
 
 		if recType == 0:  # Data record
-			while len(data) < addr + recLen:
-				data.append(0)
-			for i in range(0, recLen):
-				data[addr + i] = int(line[i * 2 + 9:i * 2 + 11], 16)
+			records.append((addr, raw[4:4 + recLen]))
+			if end < addr + recLen:
+				end = addr + recLen
 		elif recType == 1:  # End Of File record
 			pass
+		elif recType in (2, 4) and recLen != 2:  # 扩展地址记录必须带2字节数据
+			raise formatError("Length error in hex file @ " + line.decode("ascii"))
 		elif recType == 2:  # Extended Segment Address Record
-			extraAddr = int(line[9:13], 16) * 16
+			extraAddr = ((raw[4] << 8) | raw[5]) * 16
 		elif recType == 3:  # Start Segment Address Record
 			raise formatError("Dont support record type 03")
 		elif recType == 4:  # Extended Linear Address Record
-			extraAddr = int(line[9:13], 16) << 16
+			extraAddr = ((raw[4] << 8) | raw[5]) << 16
 		elif recType == 5:  # Start Linear Address Record
 			raise formatError("Dont support record type 05")
 		else:
-			print(recType, recLen, addr, checkSum, line)
-	f.close()
+			log.warning("Unknown record type %d @ %s", recType, line.decode("ascii"))
+
+	# 先解析全部记录, 再一次性分配镜像并按顺序拷贝
+	data = bytearray(b'\xff') * end
+	for addr, payload in records:
+		data[addr:addr + len(payload)] = payload
 	return data
 
 
+def _badField(line):
+	"""
+	Name the record field holding the first non hex digit of line. Only used to build error messages.
+	"""
+	text = line[1:].decode("ascii", "replace")
+	pos = next(i for i, c in enumerate(text) if c not in string.hexdigits)
+	if pos < 2:
+		return "record length"
+	elif pos < 6:
+		return "address"
+	elif pos < 8:
+		return "record type"
+	elif pos < len(text) - 2:
+		return "data"
+	else:
+		return "checksum"
+
+
 class formatError(Exception):
 
 	def __init__(self, value):
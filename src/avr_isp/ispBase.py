@@ -3,6 +3,8 @@ Created on 2017年8月15日
 
 @author: CreatBot-SW
 '''
+import logging
+
 from avr_isp import chipDB
 
 #===============================================================================
@@ -13,6 +15,8 @@ from avr_isp import chipDB
 #  Currently only the stk500v2 subclass exists.
 #===============================================================================
 
+log = logging.getLogger(__name__)
+
 
 class IspBase():
 	"""
@@ -28,9 +32,9 @@ class IspBase():
 			raise IspError("Chip with signature: " + str(self.getSignature()) + "not found")
 		self.chipErase()
 
-		print("Flashing %i bytes" % len(flashData))
+		log.info("Flashing %i bytes", len(flashData))
 		self.writeFlash(flashData)
-		print("Verifying %i bytes" % len(flashData))
+		log.info("Verifying %i bytes", len(flashData))
 		self.verifyFlash(flashData)
 
 	def getSignature(self):
@@ -8,24 +8,62 @@ Created on 2017年8月15日
 # The STK500v2 protocol is used by the ArduinoMega2560 and a few other Arduino platforms to load firmware.
 #===============================================================================
 
+import logging
 import struct, sys
 import time
+from collections import deque
 
-from PyQt5.QtCore import QIODevice, QThread, pyqtSignal
+from PyQt5.QtCore import QElapsedTimer, QIODevice, QMutex, QThread, QWaitCondition, pyqtSignal
 from PyQt5.QtSerialPort import QSerialPort, QSerialPortInfo
 from PyQt5.QtWidgets import QApplication
 
 from avr_isp import intelHex, ispBase
 
+log = logging.getLogger(__name__)
+
+
+def setLowLatency(portName):
+	"""
+	Lower the USB-serial latency timer of an FTDI style adapter to 1ms (Linux only, best effort).
+	The default of 16ms is paid on every reply. Other platforms and CDC-ACM devices have no such timer.
+	"""
+	if not sys.platform.startswith("linux"):
+		return
+	try:
+		with open("/sys/bus/usb-serial/devices/%s/latency_timer" % portName, "w") as f:
+			f.write("1\n")
+	except OSError:
+		pass
+
+
+def xorChecksum(data):
+	"""
+	XOR all bytes of data together. The bytes are folded as one big integer,
+	halving its width each step, so the loop runs log2(len(data)) times.
+	"""
+	x = int.from_bytes(data, "little")
+	width = 8 << (len(data) - 1).bit_length()
+	while width > 8:
+		width >>= 1
+		x = (x >> width) ^ (x & ((1 << width) - 1))
+	return x
+
 
 class Stk500v2(ispBase.IspBase, QSerialPort):
 		progressCallback = pyqtSignal(int, int)
+		writeWindow = 1  # 烧写时允许同时未应答的页数, 原版bootloader只能为1
+		progressInterval = 0.02  # 进度信号最小间隔(秒)
+		signOnTimeout = 1000  # 复位后等待bootloader应答的最长时间(毫秒)
 
 		def __init__(self):
 			super(Stk500v2, self).__init__()
 			self.seq = 1
 			self.lastAddr = -1
 			self.portInfo = None
+			self.rxBuf = bytearray()
+			self.lastProgress = 0.0
+			self.loadAddrChip = None
+			self.loadAddrCmd = None
 
 		def connect(self, port = 'COM4', speed = 115200):
 			self.portInfo = QSerialPortInfo(port)
@@ -38,6 +76,7 @@ class Stk500v2(ispBase.IspBase, QSerialPort):
 				if self.portInfo.isBusy():
 					raise portError(portError.errorBusy, port)
 				else:
+					setLowLatency(self.portInfo.portName())
 					if self.open(QIODevice.ReadWrite):
 # 						self.setBreakEnabled()
 						self.entryISP()
@@ -47,6 +86,7 @@ class Stk500v2(ispBase.IspBase, QSerialPort):
 		def close(self):
 			super(Stk500v2, self).close()
 			self.portInfo = None
+			del self.rxBuf[:]
 
 		def entryISP(self):
 			self.seq = 1
@@ -54,140 +94,171 @@ class Stk500v2(ispBase.IspBase, QSerialPort):
 			self.setDataTerminalReady(True)
 			QThread.msleep(100)
 			self.setDataTerminalReady(False)
-			QThread.msleep(200)
 			self.clear()
+			del self.rxBuf[:]
 
-			recv = self.sendMessage([1])[3:]
-			if "".join([chr(c) for c in recv]) != "AVRISP_2":
-				raise ispBase.IspError("Unkonwn bootloaders!")
+			recv = self.signOn()[3:]
+			if recv != b"AVRISP_2":
+				raise ispBase.IspError("Unknown bootloader!")
 
-			if self.sendMessage([0x10, 0xc8, 0x64, 0x19, 0x20, 0x00, 0x53, 0x03, 0xac, 0x53, 0x00, 0x00]) != [0x10, 0x00]:
+			if self.sendMessage(bytes([0x10, 0xc8, 0x64, 0x19, 0x20, 0x00, 0x53, 0x03, 0xac, 0x53, 0x00, 0x00])) != b'\x10\x00':
 				raise ispBase.IspError("Failed to enter programming mode!")
 
+		def signOn(self):
+			"""
+			Repeat the sign-on command until the bootloader answers, instead of sleeping a fixed time after reset.
+			Replies to earlier attempts carry an older sequence number and are skipped by recvMessage.
+			"""
+			timer = QElapsedTimer()
+			timer.start()
+			while True:
+				try:
+					return self.recvMessage(self.postMessage(b'\x01'), 50)
+				except ispBase.IspError:
+					if timer.hasExpired(self.signOnTimeout):
+						raise
+
 		def leaveISP(self):
 			if self.portInfo is not None:
-				if self.sendMessage([0x11]) != [0x11, 0x00]:
+				if self.sendMessage(b'\x11') != b'\x11\x00':
 					raise ispBase.IspError("Failed to leave programming mode!")
 
 		def isConnected(self):
 			return self.isOpen()
 
 		def sendISP(self, data):
-			recv = self.sendMessage([0x1D, 4, 4, 0, data[0], data[1], data[2], data[3]])
+			recv = self.sendMessage(bytes([0x1D, 4, 4, 0, data[0], data[1], data[2], data[3]]))
 			return recv[2:6]
 
+		def setLoadAddr(self):
+			""" Set load addr to 0, the command is built once per chip. """
+			if self.loadAddrChip is not self.chip:
+				# In case we have more then 64k flash we need to enable the address extension
+				flashSize = self.chip['pageSize'] * 2 * self.chip['pageCount']
+				self.loadAddrCmd = bytes([0x06, 0x80 if flashSize > 0xFFFF else 0x00, 0x00, 0x00, 0x00])
+				self.loadAddrChip = self.chip
+			self.sendMessage(self.loadAddrCmd)
+
 		def writeFlash(self, flashData):
-			# Set load addr to 0, in case we have more then 64k flash we need to enable the address extension
+			self.setLoadAddr()
 			pageSize = self.chip['pageSize'] * 2
-			flashSize = pageSize * self.chip['pageCount']
-			if flashSize > 0xFFFF:
-				self.sendMessage([0x06, 0x80, 0x00, 0x00, 0x00])
-			else:
-				self.sendMessage([0x06, 0x00, 0x00, 0x00, 0x00])
-
 			loadCount = (len(flashData) + pageSize - 1) // pageSize
+			total = loadCount * 2
+			header = bytes([0x13, (pageSize >> 8) & 0xFF, pageSize & 0xFF, 0xc1, 0x0a, 0x40, 0x4c, 0x20, 0x00, 0x00])
+			flashView = memoryview(flashData)
+			inflight = deque()
+			acked = 0
 			for i in range(0, loadCount):
-				self.sendMessage([0x13, pageSize >> 8, pageSize & 0xFF, 0xc1, 0x0a, 0x40, 0x4c, 0x20, 0x00, 0x00] + flashData[(i * pageSize):(i * pageSize + pageSize)])
-				self.progressCallback.emit(i + 1, loadCount * 2)
+				if len(inflight) >= self.writeWindow:
+					self.awaitReply(inflight.popleft())
+					acked += 1
+					self.reportProgress(acked, total)
+				page = flashView[i * pageSize:i * pageSize + pageSize]
+				message = header + page
+				if len(page) < pageSize:  # 最后一页不足时用0xFF补齐
+					message += b'\xff' * (pageSize - len(page))
+				inflight.append(self.postMessage(message))
+			while inflight:
+				self.awaitReply(inflight.popleft())
+				acked += 1
+				self.reportProgress(acked, total, acked == loadCount)
 
 		def verifyFlash(self, flashData):
-			# Set load addr to 0, in case we have more then 64k flash we need to enable the address extension
-			flashSize = self.chip['pageSize'] * 2 * self.chip['pageCount']
-			if flashSize > 0xFFFF:
-				self.sendMessage([0x06, 0x80, 0x00, 0x00, 0x00])
-			else:
-				self.sendMessage([0x06, 0x00, 0x00, 0x00, 0x00])
-
+			self.setLoadAddr()
+			flashView = memoryview(flashData)
 			loadCount = (len(flashData) + 0xFF) // 0x100
+			total = loadCount * 2
+			readCmd = bytes([0x14, 0x01, 0x00, 0x20])
 			for i in range(0, loadCount):
-				recv = self.sendMessage([0x14, 0x01, 0x00, 0x20])[2:0x102]
-				self.progressCallback.emit(loadCount + i + 1, loadCount * 2)
-				for j in range(0, 0x100):
-					if i * 0x100 + j < len(flashData) and flashData[i * 0x100 + j] != recv[j]:
-						raise ispBase.IspError('Verify error at: 0x%x' % (i * 0x100 + j))
+				recv = self.sendMessage(readCmd)[2:0x102]
+				self.reportProgress(loadCount + i + 1, total)
+				expected = flashView[i * 0x100:i * 0x100 + 0x100]
+				actual = recv[:len(expected)]
+				if actual != expected:  # 整块比较, 仅在出错时逐字节定位
+					j = next(j for j in range(len(expected)) if j >= len(actual) or expected[j] != actual[j])
+					raise ispBase.IspError('Verify error at: 0x%x' % (i * 0x100 + j))
+
+		def reportProgress(self, cur, total, force = False):
+			""" Emit progressCallback, but at most once per progressInterval unless forced or finished. """
+			now = time.monotonic()
+			if force or cur >= total or now - self.lastProgress >= self.progressInterval:
+				self.lastProgress = now
+				self.progressCallback.emit(cur, total)
 
 		def fastReset(self):
-			QThread.msleep(50)
+			self.waitForBytesWritten(50)
 			self.setDataTerminalReady(True)
 			self.setDataTerminalReady(False)
 
 		def sendMessage(self, data):
-			message = struct.pack(">BBHB", 0x1B, self.seq, len(data), 0x0E)
-			for c in data:
-				message += struct.pack(">B", c)
-			checksum = 0
-			for c in message:
-				checksum ^= c
-			message += struct.pack(">B", checksum)
+			""" Send a message and wait for its reply. Takes the message body as bytes, returns the reply body as bytes. """
+			return self.awaitReply(self.postMessage(data))
+
+		def postMessage(self, data):
+			""" Send a message without waiting for the reply, return its sequence number. """
+			assert isinstance(data, (bytes, bytearray, memoryview)), "message body must be bytes"
+			seq = self.seq
+			message = struct.pack(">BBHB", 0x1B, seq, len(data), 0x0E) + data
+			message += bytes([xorChecksum(message)])
 			try:
 				self.write(message)
 				self.flush()
 			except:
 				raise ispBase.IspError("Serial send timeout")
 			self.seq = (self.seq + 1) & 0xFF
-			
-			if(self.waitForReadyRead(100)):
-				return self.recvMessage()
-			else:
-				raise ispBase.IspError("Serial recv timeout")
-
-		def recvMessage(self):
-			state = 'Start'
-			checksum = 0
+			return seq
+
+		def awaitReply(self, seq):
+			""" Wait for the reply to the message with sequence number 'seq'. """
+			return self.recvMessage(seq, 100)
+
+		def recvMessage(self, expectSeq = None, timeout = 20):
+			"""
+			Parse one reply frame out of rxBuf, pulling more data with readAll() only when the buffered bytes
+			do not hold a complete frame. 'timeout' applies while no partial frame is buffered, 20ms otherwise.
+			"""
+			buf = self.rxBuf
 			while True:
-				s = self.read(1)
-				if(len(s) < 1):
-					if(self.waitForReadyRead(20)):
+				start = buf.find(0x1B)
+				del buf[:start if start >= 0 else len(buf)]
+				if len(buf) >= 5:
+					if buf[4] != 0x0E:
+						del buf[:1]
 						continue
-					else:
-						raise ispBase.IspError("Serial read timeout")
-				b = struct.unpack(">B", s)[0]
-				checksum ^= b
-				if state == 'Start':
-					if b == 0x1B:
-						state = 'GetSeq'
-						checksum = 0x1B
-				elif state == 'GetSeq':
-					state = 'MsgSize1'
-				elif state == 'MsgSize1':
-					msgSize = b << 8
-					state = 'MsgSize2'
-				elif state == 'MsgSize2':
-					msgSize |= b
-					state = 'Token'
-				elif state == 'Token':
-					if b != 0x0E:
-						state = 'Start'
-					else:
-						state = 'Data'
-						data = []
-				elif state == 'Data':
-					data.append(b)
-					if len(data) == msgSize:
-						state = 'Checksum'
-				elif state == 'Checksum':
-					if checksum != 0:
-						state = 'Start'
-					else:
-						return data
+					frameSize = 5 + ((buf[2] << 8) | buf[3]) + 1
+					if len(buf) >= frameSize:
+						frame = buf[:frameSize]
+						if xorChecksum(frame) != 0:
+							del buf[:1]
+							continue
+						del buf[:frameSize]
+						if expectSeq is None or frame[1] == expectSeq:
+							return bytes(frame[5:-1])
+						continue
+				if(self.bytesAvailable() > 0 or self.waitForReadyRead(20 if buf else timeout)):
+					buf += bytes(self.readAll())
+				elif buf:
+					raise ispBase.IspError("Serial read timeout")
+				else:
+					raise ispBase.IspError("Serial recv timeout")
 
 
 class portError(Exception):
 	errorInvalid = 0
 	errorBusy = 1
 	errorOpen = 2
+	messages = {
+		errorInvalid: "Invalid serial port : {} !",
+		errorBusy: "Serial port {} is busy!",
+		errorOpen: "Serial port {} failed to open!",
+	}
 
 	def __init__(self, value, port):
 		self.value = value
 		self.port = str(port)
 
 	def __str__(self):
-		if self.value == self.errorInvalid:
-			return "Invalid serial port : " + self.port + " !"
-		elif self.value == self.errorBusy:
-			return "Serial port " + self.port + " is busy!"
-		elif self.value == self.errorOpen:
-			return "Serial port " + self.port + " failed to open!"
+		return self.messages[self.value].format(self.port)
 
 
 class stk500v2Thread(QThread):
@@ -202,6 +273,8 @@ class stk500v2Thread(QThread):
 		self.callback = callback
 		self.programmer = None
 		self.isWork = False
+		self.mutex = QMutex()
+		self.ackCondition = QWaitCondition()
 		self.finished.connect(self.done)
 
 	def run(self):
@@ -222,12 +295,14 @@ class stk500v2Thread(QThread):
 				self.programmer.programChip(intelHex.readHex(self.filename))
 		except Exception as e:
 			if(self.isInterruptionRequested()):
-				print("Int")
+				log.debug("Interrupted")
 			else:
 				if self.parent is not None:
 					self.stateCallback[Exception].emit(e)
+					self.mutex.lock()
 					while(self.isWork):
-						pass  # 等待父进程处理异常
+						self.ackCondition.wait(self.mutex)  # 等待父进程处理异常
+					self.mutex.unlock()
 				else:
 					raise e
 			self.isWork = False
@@ -237,6 +312,13 @@ class stk500v2Thread(QThread):
 				self.programmer.close()
 			self.programmer = None
 
+	def acknowledge(self):
+		""" Called by the parent once it has handled the reported exception. """
+		self.mutex.lock()
+		self.isWork = False
+		self.ackCondition.wakeAll()
+		self.mutex.unlock()
+
 	def isReady(self):
 		return self.programmer is not None and self.programmer.isConnected()
 
@@ -246,16 +328,17 @@ class stk500v2Thread(QThread):
 				self.isWork = False
 				self.stateCallback[str].emit(self.tr("Done!"))
 			else:
-				print("Success!")
+				log.info("Success!")
 		else:
-			print("Failure!")
+			log.warning("Failure!")
 
 	def terminate(self):
 		if self.programmer is not None:
 			self.requestInterruption()
 			self.programmer.close()
 			self.programmer = None
-			return super(stk500v2Thread, self).terminate()
+			super(stk500v2Thread, self).terminate()
+			self.wait(500)  # terminate()是异步的, 等线程真正结束后再释放
 
 
 def runProgrammer(port, speed, filename, programmer = None):
@@ -289,6 +372,7 @@ def main():
 
 
 if __name__ == '__main__':
+	logging.basicConfig(level = logging.INFO)
 # 	main()
 # 	runProgrammer("COM4", 115200, "D:/OneDrive/Desktop/CreatBot F160 01 EN KTC ( AUTO_LEVELING ).hex")
 
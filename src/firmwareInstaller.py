@@ -4,12 +4,15 @@ Created on 2017年8月15日
 @author: CreatBot-SW
 '''
 
+import logging
 import os
 import sys
+import time
+from functools import lru_cache
 
 from PyQt5.Qt import pyqtSignal
-from PyQt5.QtCore import QSize, QDir, QTimer
-from PyQt5.QtGui import QIcon
+from PyQt5.QtCore import Qt, QSize, QDir, QTimer, QEvent
+from PyQt5.QtGui import QIcon, QIntValidator
 from PyQt5.QtSerialPort import QSerialPortInfo
 from PyQt5.QtWidgets import QApplication, QVBoxLayout, QGroupBox, \
 	QRadioButton, QGridLayout, QWidget, QProgressBar, QStatusBar, QComboBox, QLabel, \
@@ -26,21 +29,53 @@ else:
 	bundle_dir = os.path.dirname(os.path.abspath(__file__))
 
 
+stateStyleSheet = "QStatusBar {font-weight: bold; color: black}  QStatusBar::item { border: 0 } QLabel {font-weight: bold}"
+errorStyleSheet = "QStatusBar {font-weight: bold; color: red} QStatusBar::item { border: 0 } QLabel {font-weight: bold; color: red}"
+
+portCache = {"time": None, "ports": []}
+wantedDescriptions = frozenset({"Arduino Mega 2560", "USB-SERIAL CH340"})  # 自动模式只显示2560和CH340
+
+
+def availablePorts(ttl = 0.5):
+	""" Return QSerialPortInfo.availablePorts(), re-enumerated at most once per ttl seconds. """
+	now = time.monotonic()
+	if portCache["time"] is None or now - portCache["time"] >= ttl:
+		portCache["ports"] = QSerialPortInfo.availablePorts()
+		portCache["time"] = now
+	return portCache["ports"]
+
+
+def invalidatePortCache():
+	portCache["time"] = None
+
+
+@lru_cache(maxsize = 1)
+def appIcon():
+	return QIcon(os.path.join(bundle_dir, "ico.ico"))
+
+
+@lru_cache(maxsize = 1)
+def standardBauds():
+	return [str(baud) for baud in QSerialPortInfo.standardBaudRates()]
+
+
 def portListAll():
-	return [port.portName() for port in QSerialPortInfo.availablePorts()]
+	return [port.portName() for port in availablePorts()]
 
 
 def portList():
-	return [port.portName() for port in QSerialPortInfo.availablePorts() if port.description() == "Arduino Mega 2560"]
+	return [port.portName() for port in availablePorts() if port.description() in wantedDescriptions]
 
 
 class countLabel(QLabel):
 
+	resetSignal = pyqtSignal()
+
 	def __init__(self, text):
 		super(countLabel, self).__init__(text)
 
 	def mouseDoubleClickEvent(self, e):
-		self.setText("0")
+		self.resetSignal.emit()
 		return super(countLabel, self).mouseDoubleClickEvent(e)
 
 
@@ -61,21 +96,34 @@ class mainWindow(QWidget):
 	def __init__(self):
 		super(mainWindow, self).__init__()
 		self.setWindowTitle(self.tr("Firmware Installer"))
-		self.setWindowIcon(QIcon(os.path.join(bundle_dir, "ico.ico")))
 		self.setFixedSize(QSize(480, 240))
 		self.setAcceptDrops(True)
 
+		self.lastPortSig = None
+		self.lastProgressUpdate = 0.0
 		self.portUpdateTimer = QTimer()
+		self.portUpdateTimer.setTimerType(Qt.CoarseTimer)
 		self.portUpdateTimer.timeout.connect(self.portUpdate)
-		self.portUpdateTimer.start(100)
+		self.portUpdateTimer.start(1000)
+		QApplication.instance().applicationStateChanged.connect(self.appStateChanged)
 		self.autoTimer = QTimer()
 		self.autoTimer.setSingleShot(True)
+		self.autoTimer.setTimerType(Qt.CoarseTimer)
 		self.autoTimer.timeout.connect(self.installFile)
 		self.task = None
+		self.autoInterval = 2000  # 自动烧写的空闲时间(毫秒), 与autoTime输入框同步
+		self.successCount = 0
+		self.failureCount = 0
+		self.tryAgainCount = 0
+		self.counterSync = QTimer()
+		self.counterSync.setSingleShot(True)
+		self.counterSync.setInterval(100)  # 计数变化合并到100毫秒内刷新一次
+		self.counterSync.timeout.connect(self.syncCounters)
 
 		self.initUI()
 		self.configUI()
 		self.resize()
+		QTimer.singleShot(0, lambda: self.setWindowIcon(appIcon()))  # 窗口显示后再加载图标
 
 	def initUI(self):
 		mainLayout = QVBoxLayout()
@@ -129,7 +177,7 @@ class mainWindow(QWidget):
 		self.autoTimeLabel = QLabel(self.tr("Idle Time:"))
 		self.autoTimeLabel2 = QLabel(self.tr("s"))
 		self.autoTime = QLineEdit("2")
-		self.autoTime.setInputMask("00")
+		self.autoTime.setValidator(QIntValidator(1, 99, self))
 		self.autoTime.setMaximumWidth(20)
 
 		layout1 = QVBoxLayout()
@@ -199,7 +247,11 @@ class mainWindow(QWidget):
 		self.setLayout(mainLayout)
 
 	def configUI(self):
-		self.baudCombo.addItems([str(baud) for baud in QSerialPortInfo.standardBaudRates()])
+		self.baudCombo.setUpdatesEnabled(False)
+		self.baudCombo.addItems(standardBauds())
+		self.baudCombo.setUpdatesEnabled(True)
+		self.portCombo.setSizeAdjustPolicy(QComboBox.AdjustToContents)
+		self.baudCombo.setSizeAdjustPolicy(QComboBox.AdjustToContentsOnFirstShow)  # 波特率列表固定不变
 
 		self.progress.hide()
 		self.statusBar.hide()
@@ -215,8 +267,12 @@ class mainWindow(QWidget):
 		self.autoCheck.toggled.connect(self.autoTimeLabel2.setEnabled)
 		self.autoCheck.stateChanged.connect(self.autoStateChangeAction)
 		self.portCombo.showPopupSignal.connect(self.portUpdate)
+		self.autoTime.textChanged.connect(self.autoTimeEdited)
 		self.autoTime.returnPressed.connect(self.autoTimeChangeAction)
 		self.statusBar.messageChanged.connect(self.stateClearAction)
+		self.errorHandlers = {portError: self.portErrorAction, IspError: self.ispErrorAction, formatError: self.formatErrorAction}
+		self.countSuccess.resetSignal.connect(lambda: self.setSuccessCount(0))
+		self.countFailure.resetSignal.connect(lambda: self.setFailureCount(0))
 
 		self.autoCheck.click()
 		self.autoCheck.click()
@@ -229,25 +285,70 @@ class mainWindow(QWidget):
 
 		self.file.__class__.dragEnterEvent = self.dragEnterEvent
 
+	def appStateChanged(self, state):
+		if state in (Qt.ApplicationSuspended, Qt.ApplicationHidden):
+			self.portUpdateTimer.stop()  # 程序不可见时不再枚举串口
+		elif state == Qt.ApplicationActive:
+			self.resumePortUpdate()
+
+	def changeEvent(self, e):
+		if e.type() == QEvent.WindowStateChange:  # Windows和桌面Linux最小化时只会收到这个事件
+			if self.isMinimized():
+				self.portUpdateTimer.stop()
+			else:
+				self.resumePortUpdate()
+		return super(mainWindow, self).changeEvent(e)
+
+	def resumePortUpdate(self):
+		if not self.portUpdateTimer.isActive() and not self.isMinimized():
+			self.portUpdateTimer.start()  # 沿用原来的间隔
+			self.portUpdate()
+
 	def portUpdate(self, forceUpdate = False):
+		if not self.isVisible() or self.isMinimized() or (self.task is not None and self.task.isRunning()):
+			return  # 窗口不可见, 最小化或正在烧写时不枚举串口, 避免与烧写线程争用设备
+		if forceUpdate:
+			invalidatePortCache()
+		portItems = [(port.portName(), port.description()) for port in availablePorts()]
+		portSig = (self.autoRadio.isChecked(), frozenset(portItems))
+		if portSig == self.lastPortSig and not forceUpdate:
+			return  # 端口和模式均未变化
+		self.lastPortSig = portSig
+
 		if self.autoRadio.isChecked():
 			self.baudCombo.setCurrentText("115200")
 # 			self.portCombo.addItems(portList())
-			self.portCombo.clear()
-			for port in QSerialPortInfo.availablePorts():
-				if port.description() not in ["Arduino Mega 2560", "USB-SERIAL CH340"]:  # 过滤2560和CH340
-						continue
-				self.portCombo.addItem(port.portName() + " (" + port.description() + ")" , port.portName())
+			self.refillPortCombo([item for item in portItems if item[1] in wantedDescriptions])  # 过滤2560和CH340
 		else:
 			currentPortData = self.portCombo.currentData()
-			if forceUpdate or (currentPortData and currentPortData not in [port.portName() for port in QSerialPortInfo.availablePorts()]):
-				self.portCombo.clear()
-				for port in QSerialPortInfo.availablePorts():
-					self.portCombo.addItem(port.portName() + " (" + port.description() + ")" , port.portName())
-				self.portCombo.setCurrentIndex(self.portCombo.findData(currentPortData))
-					
-		self.portCombo.setSizeAdjustPolicy(QComboBox.AdjustToContents)
-		self.baudCombo.setSizeAdjustPolicy(QComboBox.AdjustToContents)
+			if forceUpdate or (currentPortData and currentPortData not in {name for name, _ in portItems}):
+				self.refillPortCombo(portItems, True)
+
+	def refillPortCombo(self, portItems, keepSelection = False):
+		"""
+		Bring portCombo in line with (portName, description) pairs, touching only the items that changed.
+		With keepSelection a vanished current port leaves the combo empty instead of falling back to a neighbour.
+		"""
+		wanted = dict(portItems)
+		currentGone = self.portCombo.currentData() not in wanted
+		existing = {self.portCombo.itemData(i): i for i in range(self.portCombo.count())}
+		self.portCombo.setUpdatesEnabled(False)
+		self.portCombo.blockSignals(True)
+		for index in sorted((i for name, i in existing.items() if name not in wanted), reverse = True):
+			self.portCombo.removeItem(index)  # 倒序删除, 保证前面的索引不变
+		existing = {self.portCombo.itemData(i): i for i in range(self.portCombo.count())}
+		for name, description in portItems:
+			text = f"{name} ({description})"
+			index = existing.get(name, -1)
+			if index < 0:
+				self.portCombo.addItem(text, name)
+			elif self.portCombo.itemText(index) != text:
+				self.portCombo.setItemText(index, text)
+		if keepSelection and currentGone:
+			self.portCombo.setCurrentIndex(-1)  # 手动模式下选中的端口已移除, 不自动改选其他端口
+		self.portCombo.blockSignals(False)
+		self.portCombo.setUpdatesEnabled(True)
+		self.portCombo.update()
 
 	def disableAutoInstall(self):
 		self.autoCheck.setChecked(False)
@@ -256,6 +357,12 @@ class mainWindow(QWidget):
 		if not check and self.autoTimer.remainingTime() > 0:
 			self.stopInstall()
 
+	def autoTimeEdited(self, text):
+		try:
+			self.autoInterval = max(1, int(text)) * 1000
+		except ValueError:
+			pass  # 输入过程中为空, 保留上一次的值
+
 	def autoTimeChangeAction(self):
 		self.autoTime.clearFocus()
 		if self.autoCheck.isChecked() and self.autoTimer.remainingTime() > 0:
@@ -270,21 +377,16 @@ class mainWindow(QWidget):
 		self.resize()
 
 	def selectFile(self):
-		hexFileDialog = QFileDialog()
-		hexFileDialog.setWindowTitle(self.tr("Select hex file"))
-		hexFileDialog.setNameFilter(self.tr("Hex files(*.hex)"))
-		hexFileDialog.setFileMode(QFileDialog.ExistingFile)
-		if(self.file.text() is ""):
-			hexFileDialog.setDirectory(QDir.home())  # 设置为Home目录
+		if(self.file.text() == ""):
+			fileDir = QDir.home()  # 设置为Home目录
 		else:
 			fileDir = QDir(self.file.text())
 			fileDir.cdUp()
-			if(fileDir.exists()):
-				hexFileDialog.setDirectory(fileDir)  # 设置为当前文件所在目录
-			else:
-				hexFileDialog.setDirectory(QDir.home())
-		if(hexFileDialog.exec()):
-			self.file.setText(hexFileDialog.selectedFiles()[0])
+			if(not fileDir.exists()):
+				fileDir = QDir.home()  # 当前文件所在目录不存在时回到Home目录
+		fileName, _ = QFileDialog.getOpenFileName(self, self.tr("Select hex file"), fileDir.absolutePath(), self.tr("Hex files(*.hex)"))
+		if(fileName):
+			self.file.setText(fileName)
 
 	def installFile(self, notFromButton = True):
 		if(self.file.text() is ""):
@@ -302,6 +404,8 @@ class mainWindow(QWidget):
 			self.progress.show()
 			self.resize()
 
+			if self.autoRadio.isChecked():
+				self.portUpdate(True)  # 自动模式下(含重试)烧写前重新枚举, 不依赖1秒的轮询
 			self.task = stk500v2Thread(self, self.portCombo.currentData(), int(self.baudCombo.currentText()), self.file.text(), self.progressUpdate)
 			self.task.stateCallback[str].connect(self.stateUpdate)
 			self.task.stateCallback[Exception].connect(self.stateUpdate)
@@ -319,11 +423,11 @@ class mainWindow(QWidget):
 			self.stopBtn.setDisabled(True)
 			self.progress.reset()
 			self.progress.hide()
-			self.tryAgain.setText("0")
+			self.setTryAgainCount(0)
 			self.resize()
 
 		if succeed:
-			self.countSuccess.setText(str(int(self.countSuccess.text()) + 1))
+			self.setSuccessCount(self.successCount + 1)
 			self.task = None
 		else:
 			if self.autoTimer.remainingTime() is not -1:
@@ -331,7 +435,7 @@ class mainWindow(QWidget):
 			if self.task is not None and self.task.isRunning():
 					self.task.finished.disconnect()
 					if self.task.isReady():
-						self.countFailure.setText(str(int(self.countFailure.text()) + 1))
+						self.setFailureCount(self.failureCount + 1)
 
 					if(self.task.isInterruptionRequested()):
 						pass
@@ -346,66 +450,104 @@ class mainWindow(QWidget):
 	def autoAction(self):
 		self.stopInstall(True, self.autoCheck.isChecked())
 		if self.autoCheck.isChecked():
-			self.autoTimer.start(int(self.autoTime.text()) * 1000)
+			self.autoTimer.start(self.autoInterval)
+
+	def setSuccessCount(self, count):
+		self.successCount = count
+		self.scheduleCounterSync()
+
+	def setFailureCount(self, count):
+		self.failureCount = count
+		self.scheduleCounterSync()
+
+	def setTryAgainCount(self, count):
+		self.tryAgainCount = count
+		self.scheduleCounterSync()
+
+	def scheduleCounterSync(self):
+		if not self.counterSync.isActive():
+			self.counterSync.start()
+
+	def syncCounters(self):
+		""" Copy the counters to their labels, skipping the ones that did not change. """
+		for label, count in ((self.countSuccess, self.successCount), (self.countFailure, self.failureCount), (self.tryAgain, self.tryAgainCount)):
+			text = str(count)
+			if label.text() != text:
+				label.setText(text)
 
 	def resize(self):
 		self.setFixedHeight(self.sizeHint().height())
 
 	def progressUpdate(self, cur, total):
+		now = time.monotonic()
+		if cur != total and now - self.lastProgressUpdate < 0.033:
+			return  # 限制进度条刷新到约30Hz
+		self.lastProgressUpdate = now
 		self.progress.setMaximum(total)
 		self.progress.setValue(cur)
 
+	def setStatusStyle(self, styleSheet):
+		if self.statusBar.styleSheet() != styleSheet:  # 样式表每次设置都会重新解析
+			self.statusBar.setStyleSheet(styleSheet)
+
 	def stateUpdate(self, stateOrError):
 		self.tryAgainLabel.setHidden(True)
 		self.tryAgain.setHidden(True)
 		if self.task.isReady():
-			self.tryAgain.setText("0")
+			self.setTryAgainCount(0)
 
 		if type(stateOrError) == str:
 # 		self.statusBar.setStyleSheet("QStatusBar::item { border: 0 } QLabel {color: red; font-weight: bold}")
-			self.statusBar.setStyleSheet("QStatusBar {font-weight: bold; color: black}  QStatusBar::item { border: 0 } QLabel {font-weight: bold}")
+			self.setStatusStyle(stateStyleSheet)
 			if self.task is not None and not self.task.isWork and not self.autoCheck.isChecked():
 				self.statusBar.showMessage(stateOrError, 3000)
 			else:
 				self.statusBar.showMessage(stateOrError)
 		else:
 			self.task.requestInterruption()
-			self.statusBar.setStyleSheet("QStatusBar {font-weight: bold; color: red} QStatusBar::item { border: 0 } QLabel {font-weight: bold; color: red}")
-
-			if type(stateOrError) == portError:
-				if (stateOrError.value in [portError.errorInvalid, portError.errorBusy]) and (int(self.tryAgain.text()) < 20):
-					self.statusBar.showMessage("PortError: " + str(stateOrError))
-					self.tryAgain.setText(str(int(self.tryAgain.text()) + 1))
-					self.tryAgainLabel.setVisible(True)
-					self.tryAgain.setVisible(True)
-					self.stopInstall(autoInstall = True)
-					self.autoTimer.start(1000)  # 1秒自动重试
-				else:
-					self.statusBar.showMessage("PortError: " + str(stateOrError), 5000)
-					self.stopInstall()
-			elif type(stateOrError) == IspError:
-				if self.autoCheck.isChecked():
-					self.statusBar.showMessage("IspError: " + str(stateOrError))
-					self.tryAgainLabel.setVisible(True)
-					self.tryAgain.setVisible(True)
-					self.stopInstall(autoInstall = True)
-					self.autoTimer.start(int(self.autoTime.text()) * 1000)
-				else:
-					self.statusBar.showMessage("IspError: " + str(stateOrError), 5000)
-					self.stopInstall()
-			elif type(stateOrError) == formatError:
-				self.statusBar.showMessage("HexError: " + str(stateOrError), 5000)
-				self.stopInstall()
-			else:
-				self.statusBar.showMessage("Error: " + str(stateOrError), 5000)
-				self.stopInstall()
+			self.setStatusStyle(errorStyleSheet)
+
+			self.errorHandlers.get(type(stateOrError), self.otherErrorAction)(stateOrError)
 
-			self.task.isWork = False
+			self.task.acknowledge()
 			self.task.wait(100)
 			self.task = None
 
+	def portErrorAction(self, error):
+		if (error.value in [portError.errorInvalid, portError.errorBusy]) and (self.tryAgainCount < 20):
+			self.statusBar.showMessage("PortError: " + str(error))
+			self.setTryAgainCount(self.tryAgainCount + 1)
+			self.tryAgainLabel.setVisible(True)
+			self.tryAgain.setVisible(True)
+			self.stopInstall(autoInstall = True)
+			self.autoTimer.start(1000)  # 1秒自动重试
+		else:
+			self.statusBar.showMessage("PortError: " + str(error), 5000)
+			self.stopInstall()
+
+	def ispErrorAction(self, error):
+		if self.autoCheck.isChecked():
+			self.statusBar.showMessage("IspError: " + str(error))
+			self.tryAgainLabel.setVisible(True)
+			self.tryAgain.setVisible(True)
+			self.stopInstall(autoInstall = True)
+			self.autoTimer.start(self.autoInterval)
+		else:
+			self.statusBar.showMessage("IspError: " + str(error), 5000)
+			self.stopInstall()
+
+	def formatErrorAction(self, error):
+		self.statusBar.showMessage("HexError: " + str(error), 5000)
+		self.stopInstall()
+
+	def otherErrorAction(self, error):
+		self.statusBar.showMessage("Error: " + str(error), 5000)
+		self.stopInstall()
+
 
 if __name__ == '__main__':
+	logLevel = logging.getLevelName(os.environ.get("FWI_LOG", "WARNING").upper())
+	logging.basicConfig(level = logLevel if isinstance(logLevel, int) else logging.WARNING)  # 未知级别按WARNING处理
 	app = QApplication(sys.argv)
 
 	win = mainWindow()